@@ -0,0 +1,80 @@
+# cython: language_level=3
+# -*- coding: utf-8 -*-
+"""
+Acelerador opcional (Cython) do caminho de canonicalização tpNFTS.
+
+Compilar com:
+  python setup.py build_ext --inplace
+
+O script de assinatura importa este módulo quando disponível e cai no
+caminho Python puro equivalente quando o import falha — o resultado é
+byte a byte idêntico nos dois caminhos.
+"""
+
+from xml.sax.saxutils import escape
+
+# lxml escapa &, <, > e \r no texto — reproduzir o mesmo escaping
+_XML_TEXT_ENTITIES = {'\r': '&#13;'}
+
+DEF KIND_GROUP = 7
+
+
+cdef void _emit(bytearray buf, bytes tag, str text):
+    buf += b'<'
+    buf += tag
+    buf += b'>'
+    buf += escape(text, _XML_TEXT_ENTITIES).encode('utf-8')
+    buf += b'</'
+    buf += tag
+    buf += b'>'
+
+
+cdef void _emit_fragment(bytearray buf, node, tuple schema, tuple normalizers):
+    cdef dict children = {}
+    cdef str tag_name, final
+    cdef bytes tag_bytes
+    cdef int kind
+    cdef Py_ssize_t mark, inner
+
+    # um único passe sobre os filhos; nome local sem alocar QName
+    for c in node:
+        tag = c.tag
+        if type(tag) is not str:
+            continue  # comentários / PIs
+        if tag[0] == '{':
+            tag = tag[tag.rindex('}') + 1:]
+        children[tag] = c
+
+    for tag_name, tag_bytes, kind, sub_schema in schema:
+        child = children.get(tag_name)
+        if child is None:
+            continue
+        if kind < KIND_GROUP:
+            final = normalizers[kind](child.text or "")
+            if final == "":
+                continue
+            _emit(buf, tag_bytes, final)
+        else:
+            # escreve a abertura e desfaz se o grupo ficar vazio
+            mark = len(buf)
+            buf += b'<'
+            buf += tag_bytes
+            buf += b'>'
+            inner = len(buf)
+            _emit_fragment(buf, child, <tuple>sub_schema, normalizers)
+            if len(buf) == inner:
+                del buf[mark:]
+            else:
+                buf += b'</'
+                buf += tag_bytes
+                buf += b'>'
+
+
+cpdef bytes build_canonical(nfts_node, tuple schema, tuple normalizers):
+    """Monta os bytes canônicos <tpNFTS>...</tpNFTS> de um nó NFTS."""
+    cdef bytearray buf = bytearray(b'<tpNFTS>')
+    _emit_fragment(buf, nfts_node, schema, normalizers)
+    if len(buf) == len(b'<tpNFTS>'):
+        return b'<tpNFTS/>'
+    buf += b'</tpNFTS>'
+    return bytes(buf)
@@ -6,24 +6,67 @@ Script para comparar arquivos de debug entre C# e Python
 
 import os
 import sys
+from functools import lru_cache
+
+# Quantos bytes ler de cada arquivo para exibir o diff quando os tamanhos diferem
+_DIFF_PREFIX_LEN = 64 * 1024
+
+@lru_cache(maxsize=16)
+def _read_once(path):
+    """Lê o arquivo uma única vez por execução (cacheado por caminho)"""
+    with open(path, 'rb') as f:
+        return f.read()
 
 def compare_files(file1, file2, description):
-    """Compara dois arquivos binários"""
-    if not os.path.exists(file1):
+    """Compara dois arquivos binários.
+
+    Retorna (iguais, data1, data2) para que o chamador reutilize os bytes
+    sem reler os arquivos.
+    """
+    exists1 = os.path.exists(file1)
+    exists2 = os.path.exists(file2)
+    if not exists1:
         print(f"❌ {description}: Arquivo 1 não encontrado: {file1}")
-        return False
-    if not os.path.exists(file2):
+    if not exists2:
         print(f"❌ {description}: Arquivo 2 não encontrado: {file2}")
-        return False
-    
-    with open(file1, 'rb') as f1:
-        data1 = f1.read()
-    with open(file2, 'rb') as f2:
-        data2 = f2.read()
-    
+    if not (exists1 and exists2):
+        return (False,
+                _read_once(file1) if exists1 else None,
+                _read_once(file2) if exists2 else None)
+
+    # Comparar tamanhos antes de ler: falha rápida sem carregar os arquivos
+    size1 = os.path.getsize(file1)
+    size2 = os.path.getsize(file2)
+    if size1 != size2:
+        print(f"❌ {description}: DIFERENTES")
+        print(f"   Arquivo 1: {size1} bytes")
+        print(f"   Arquivo 2: {size2} bytes")
+
+        # Ler apenas um prefixo de cada arquivo para localizar a diferença
+        with open(file1, 'rb') as f:
+            head1 = f.read(_DIFF_PREFIX_LEN)
+        with open(file2, 'rb') as f:
+            head2 = f.read(_DIFF_PREFIX_LEN)
+        min_len = min(len(head1), len(head2))
+        for i in range(min_len):
+            if head1[i] != head2[i]:
+                print(f"   Primeira diferença no byte {i}:")
+                start = max(0, i-5)
+                end = min(min_len, i+6)
+                print(f"   Arquivo 1 [{start}:{end}]: {head1[start:end].hex()}")
+                print(f"   Arquivo 2 [{start}:{end}]: {head2[start:end].hex()}")
+                break
+        else:
+            print(f"   Conteúdo idêntico até o byte {min_len} (tamanhos diferem)")
+
+        return False, head1, head2
+
+    data1 = _read_once(file1)
+    data2 = _read_once(file2)
+
     if data1 == data2:
         print(f"✅ {description}: IGUAIS ({len(data1)} bytes)")
-        return True
+        return True, data1, data2
     else:
         print(f"❌ {description}: DIFERENTES")
         print(f"   Arquivo 1: {len(data1)} bytes")
@@ -39,8 +82,8 @@ def compare_files(file1, file2, description):
                 print(f"   Arquivo 1 [{start}:{end}]: {data1[start:end].hex()}")
                 print(f"   Arquivo 2 [{start}:{end}]: {data2[start:end].hex()}")
                 break
-        
-        return False
+
+        return False, data1, data2
 
 def main():
     # Diretórios
@@ -65,35 +108,27 @@ def main():
     # Comparar hash
     print("2. HASH SHA1")
     print("-"*70)
-    hash_equal = compare_files(
+    hash_equal, hash_csharp, hash_python = compare_files(
         os.path.join(csharp_dir, "hash_NFTS_1.bin"),
         os.path.join(python_dir, "hash_NFTS_1.bin"),
         "hash_NFTS_1.bin"
     )
-    
-    # Mostrar hash em hex
-    hash_file_csharp = os.path.join(csharp_dir, "hash_NFTS_1.bin")
-    hash_file_python = os.path.join(python_dir, "hash_NFTS_1.bin")
-    
-    if os.path.exists(hash_file_csharp):
-        with open(hash_file_csharp, 'rb') as f:
-            hash_csharp = f.read()
+
+    # Mostrar hash em hex (reutilizando os bytes já lidos na comparação)
+    if hash_csharp is not None:
         print(f"   C# Hash (hex):     {hash_csharp.hex()}")
-    
-    if os.path.exists(hash_file_python):
-        with open(hash_file_python, 'rb') as f:
-            hash_python = f.read()
+    if hash_python is not None:
         print(f"   Python Hash (hex): {hash_python.hex()}")
     print()
-    
+
     # Comparar assinatura
     print("3. ASSINATURA")
     print("-"*70)
-    
+
     # C# gera signature_NFTS_1.bin
     # Python gera signature_NFTS_1.bin e possivelmente signature_NFTS_1_method1.bin
-    
-    sig_equal = compare_files(
+
+    sig_equal, _, _ = compare_files(
         os.path.join(csharp_dir, "signature_NFTS_1.bin"),
         os.path.join(python_dir, "signature_NFTS_1.bin"),
         "signature_NFTS_1.bin"
@@ -0,0 +1,94 @@
+# cython: language_level=3
+# -*- coding: utf-8 -*-
+"""
+Acelerador opcional (Cython) dos normalize_* usados na canonicalização.
+
+Compilar com:
+  python setup.py build_ext --inplace
+
+sign_xml_soap_nfts_novos_campos.py importa estas funções quando o módulo
+compilado existe e mantém as versões Python puras como fallback — o
+resultado é byte a byte idêntico nos dois caminhos.
+"""
+
+from cpython.unicode cimport Py_UNICODE_ISSPACE
+
+_BOOL_TRUE = frozenset((u"true", u"1", u"s", u"sim", u"t", u"y", u"yes"))
+_fmt = u"{:.2f}".format
+
+
+cdef str _clean(str text, bint comma_to_dot):
+    """Equivale a replace(NBSP, ' ')[+ replace(',', '.')].strip() em um passe.
+
+    O strip vem primeiro (NBSP é whitespace unicode, então as pontas saem
+    igual); só aloca uma string nova se houver NBSP/vírgula no miolo.
+    """
+    cdef Py_ssize_t n = len(text)
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t end = n
+    cdef Py_ssize_t i
+    cdef Py_UCS4 ch
+    cdef bint changed = False
+
+    while start < end and Py_UNICODE_ISSPACE(text[start]):
+        start += 1
+    while end > start and Py_UNICODE_ISSPACE(text[end - 1]):
+        end -= 1
+
+    for i in range(start, end):
+        ch = text[i]
+        if ch == 0xA0 or (comma_to_dot and ch == 0x2C):
+            changed = True
+            break
+    if not changed:
+        return text if (start == 0 and end == n) else text[start:end]
+
+    out = []
+    for i in range(start, end):
+        ch = text[i]
+        if ch == 0xA0:
+            out.append(u' ')
+        elif comma_to_dot and ch == 0x2C:
+            out.append(u'.')
+        else:
+            out.append(text[i])
+    return u''.join(out)
+
+
+cpdef str normalize_numeric_string(text):
+    if text is None:
+        return u""
+    cdef str clean_text = _clean(text, False)
+    if clean_text.isdigit():
+        # caso comum (dígitos ASCII): lstrip dispensa o round-trip int()/str()
+        if clean_text.isascii():
+            return clean_text.lstrip(u'0') or u'0'
+        try:
+            return str(int(clean_text))
+        except ValueError:
+            pass
+    return clean_text
+
+
+cpdef str normalize_serie_nfts(text):
+    if text is None:
+        return u"     "
+    return _clean(text, False)
+
+
+cpdef str normalize_float_value(text, bint format_decimals=True):
+    if text is None:
+        return u""
+    cdef str clean_text = _clean(text, True)
+    try:
+        float_value = float(clean_text)
+    except Exception:
+        return clean_text
+    return _fmt(float_value) if format_decimals else str(float_value)
+
+
+cpdef str normalize_boolean_value(text):
+    if text is None:
+        return u"false"
+    cdef str clean_text = _clean(text, False).lower()
+    return u"true" if clean_text in _BOOL_TRUE else u"false"
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Build dos aceleradores opcionais (canonical.pyx e normalize.pyx).
+
+  pip install cython
+  python setup.py build_ext --inplace
+
+Os .so/.pyd resultantes são detectados automaticamente pelos scripts de
+assinatura; sem eles, o caminho Python puro é usado.
+"""
+
+from setuptools import Extension, setup
+from Cython.Build import cythonize
+
+setup(
+    name="assinador-nfts-canonical",
+    ext_modules=cythonize(
+        [
+            Extension("canonical", ["canonical.pyx"], extra_compile_args=["-O3"]),
+            Extension("normalize", ["normalize.pyx"], extra_compile_args=["-O3"]),
+        ],
+        language_level=3,
+    ),
+)
@@ -20,12 +20,15 @@ Usage:
 from __future__ import annotations
 import sys
 import os
+import re
 import tempfile
 import logging
 import base64
-import copy
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Tuple, Optional
+from xml.sax.saxutils import escape
 
 from lxml import etree
 from cryptography.hazmat.primitives.serialization import pkcs12, Encoding, PrivateFormat, NoEncryption
@@ -39,6 +42,12 @@ try:
 except Exception:
     XMLSEC_AVAILABLE = False
 
+# acelerador opcional da canonicalização (ver canonical.pyx / setup.py)
+try:
+    from canonical import build_canonical as _build_canonical_c  # type: ignore
+except ImportError:
+    _build_canonical_c = None
+
 # Configuração de log (Definido como CRITICAL para silenciar a saída normal)
 logging.basicConfig(level=logging.CRITICAL, format='%(levelname)s: %(message)s')
 logger = logging.getLogger("sign_nfts")
@@ -46,9 +55,17 @@ logger = logging.getLogger("sign_nfts")
 NS_SP = "http://www.prefeitura.sp.gov.br/nfts"
 NS_SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
 
+# Parser reutilizado entre invocações (carrega estado libxml2; criar um por
+# chamada custa setup/teardown). Atenção: parsers não são thread-safe —
+# todo parse acontece antes do pool de assinatura.
+_PARSER = etree.XMLParser(remove_blank_text=True, huge_tree=False)
+
 # ---------------- util ----------------
 
+@lru_cache(maxsize=1)
 def ensure_path_for_debug() -> str:
+    # Cacheado: o caminho é estático e o makedirs é um syscall que pode
+    # custar centenas de ms em share de rede — paga uma vez por processo.
     # A função ainda existe, mas não será usada pelo sign_file após as modificações.
     # No modo --verify, ela ainda será chamada para definir o caminho
     # onde os arquivos de debug (necessários para a verificação) serão salvos.
@@ -67,33 +84,65 @@ def ensure_path_for_debug() -> str:
         dirpath = tempfile.gettempdir()
     return dirpath
 
+def _write_debug_bin(path: str, data: bytes) -> None:
+    """Grava arquivo binário de debug com um único write em fd de baixo nível."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def _children_by_localname(parent: etree._Element) -> dict:
+    """Indexa os filhos por nome local em um único passe (sem XPath)."""
+    return {
+        etree.QName(c).localname: c for c in parent if isinstance(c.tag, str)
+    }
+
 def find_child(parent: etree._Element, tagname: str) -> Optional[etree._Element]:
     """Encontra um filho por nome local, ignorando namespace."""
-    nodes = parent.xpath('./*[local-name() = $name]', name=tagname)
-    return nodes[0] if nodes else None
+    return _children_by_localname(parent).get(tagname)
 
 # ---------------- PKCS12 ----------------
 
-def read_pkcs12(pfx_path: str, password: Optional[str]) -> Tuple[object, object]:
-    """Lê private key e cert do PFX via cryptography. password pode ser ''."""
+@lru_cache(maxsize=4)
+def _load_pfx_cached(pfx_path: str, mtime: float, pwd: Optional[bytes]) -> Tuple[object, object]:
+    """Carrega e decodifica o PFX; cacheado por (caminho, mtime, senha)."""
     with open(pfx_path, "rb") as f:
         data = f.read()
-    pwd = None if password in (None, "") else password.encode("utf-8")
     private_key, cert, additional = pkcs12.load_key_and_certificates(data, pwd)
     if private_key is None or cert is None:
         raise RuntimeError("Não foi possível extrair chave privada / certificado do PFX")
     return private_key, cert
 
+def read_pkcs12(pfx_path: str, password: Optional[str]) -> Tuple[object, object]:
+    """Lê private key e cert do PFX via cryptography. password pode ser ''.
+
+    O parse do PFX (ASN.1 + import da chave RSA no OpenSSL) é caro e o mesmo
+    certificado costuma assinar vários lotes em sequência; o resultado é
+    memoizado e invalidado automaticamente quando o mtime do arquivo muda.
+    Os objetos retornados são seguros para reuso entre chamadas/threads.
+    """
+    pwd = None if password in (None, "") else password.encode("utf-8")
+    return _load_pfx_cached(pfx_path, os.path.getmtime(pfx_path), pwd)
+
 # ---------------- Normalizações ----------------
 
+# Tabelas de tradução construídas uma vez: um único passe em C substitui a
+# cadeia de .replace() (cada replace aloca uma string nova)
+_NBSP_TABLE = str.maketrans({'\xa0': ' '})
+_NBSP_COMMA_TABLE = str.maketrans({'\xa0': ' ', ',': '.'})
+
 def normalize_numeric_string(text: Optional[str]) -> str:
     """
     Normaliza retirando os zeros a esquerda de strings numéricas.
     """
     if text is None:
         return ""
-    clean_text = text.replace('\xa0', ' ').strip()
+    clean_text = text.translate(_NBSP_TABLE).strip()
     if clean_text.isdigit():
+        if clean_text.isascii():
+            # caso comum: remove zeros à esquerda sem o round-trip int()/str()
+            return clean_text.lstrip('0') or '0'
         try:
             return str(int(clean_text))
         except ValueError:
@@ -107,13 +156,17 @@ def normalize_serie_nfts(text: Optional[str]) -> str:
     """
     if text is None:
         return ""
-    clean_text = text.replace('\xa0', ' ').strip()
+    clean_text = text.translate(_NBSP_TABLE).strip()
     return clean_text
 
+# valor monetário já no formato canônico (sem zeros à esquerda, 2 casas):
+# pode ser devolvido como está, sem o round-trip float()/format
+_FAST_CURRENCY = re.compile(r'^(?:0|[1-9][0-9]*)\.[0-9]{2}$')
+
 def normalize_float_value(text: Optional[str], format_decimals: bool = True) -> str:
     """
     Normaliza valor float.
-    
+
     Args:
         text: Texto a ser normalizado
         format_decimals: Se True, formata para 2 casas decimais (ex: 3.5 -> 3.50)
@@ -121,7 +174,9 @@ def normalize_float_value(text: Optional[str], format_decimals: bool = True) ->
     """
     if text is None:
         return ""
-    clean_text = text.replace('\xa0', ' ').replace(',', '.').strip()
+    clean_text = text.translate(_NBSP_COMMA_TABLE).strip()
+    if format_decimals and _FAST_CURRENCY.match(clean_text):
+        return clean_text
     try:
         float_value = float(clean_text)
         if format_decimals:
@@ -133,194 +188,221 @@ def normalize_float_value(text: Optional[str], format_decimals: bool = True) ->
     except Exception:
         return clean_text
 
+# valores aceitos como verdadeiro (lookup O(1) no caminho por campo)
+_BOOL_TRUE_VALUES = frozenset(("true", "1", "s", "sim", "t", "y", "yes"))
+
 def normalize_boolean_value(text: Optional[str]) -> str:
     if text is None:
         return "false"
-    clean_text = text.replace('\xa0', ' ').strip().lower()
-    if clean_text in ("true", "1", "s", "sim", "t", "y", "yes"):
-        return "true"
-    return "false"
+    clean_text = text.translate(_NBSP_TABLE).strip().lower()
+    return "true" if clean_text in _BOOL_TRUE_VALUES else "false"
 
 # ---------------- Construir string canônica (tpNFTS) ----------------
 
+# Códigos de tipo do schema canônico achatado (pré-computado no import).
+# Valores < _KIND_GROUP são folhas; _KIND_GROUP indica elemento com filhos.
+_KIND_STR = 0
+_KIND_NUM = 1
+_KIND_FLOAT_CUR = 2
+_KIND_FLOAT = 3
+_KIND_BOOL = 4
+_KIND_SERIE = 5
+_KIND_STR_OPT = 6
+_KIND_GROUP = 7
+
+_KIND_BY_NAME = {
+    "str": _KIND_STR,
+    "num_str": _KIND_NUM,
+    "float_currency": _KIND_FLOAT_CUR,
+    "float": _KIND_FLOAT,
+    "bool": _KIND_BOOL,
+    "serie": _KIND_SERIE,
+    "str_opt": _KIND_STR_OPT,
+}
+
+def _normalize_plain_string(text: Optional[str]) -> str:
+    if text is None:
+        return ""
+    return text.translate(_NBSP_TABLE).strip()
+
+def _normalize_float_currency(text: Optional[str]) -> str:
+    return normalize_float_value(text, format_decimals=True)
+
+def _normalize_float_plain(text: Optional[str]) -> str:
+    return normalize_float_value(text, format_decimals=False)
+
+# Tabela de despacho indexada pelos códigos _KIND_* (apenas folhas)
+_NORMALIZERS = (
+    _normalize_plain_string,    # _KIND_STR
+    normalize_numeric_string,   # _KIND_NUM
+    _normalize_float_currency,  # _KIND_FLOAT_CUR
+    _normalize_float_plain,     # _KIND_FLOAT
+    normalize_boolean_value,    # _KIND_BOOL
+    normalize_serie_nfts,       # _KIND_SERIE
+    _normalize_plain_string,    # _KIND_STR_OPT
+)
+
+canonical_order_map = OrderedDict([
+    ("TipoDocumento", "str"),
+    ("ChaveDocumento", {
+        "InscricaoMunicipal": "str",
+        "SerieNFTS": "serie",
+        "NumeroDocumento": "str",
+    }),
+    ("DataPrestacao", "str"),
+    ("StatusNFTS", "str"),
+    ("TributacaoNFTS", "str"),
+    ("ValorServicos", "float_currency"),
+    ("ValorDeducoes", "float_currency"),
+    ("CodigoServico", "num_str"),
+    ("CodigoSubItem", "num_str"),
+    ("AliquotaServicos", "float"),
+    ("ISSRetidoTomador", "bool"),
+    ("ISSRetidoIntermediario", "bool"),
+    ("Prestador", {
+        "CPFCNPJ": {
+            "CNPJ": "str",
+            "CPF": "str",
+        },
+        "InscricaoMunicipal": "str",
+        "RazaoSocialPrestador": "str",
+        "Endereco": {
+            "TipoLogradouro": "str",
+            "Logradouro": "str",
+            "NumeroEndereco": "str",
+            "ComplementoEndereco": "str_opt",
+            "Bairro": "str",
+            "Cidade": "num_str",
+            "UF": "str",
+            "CEP": "num_str",
+        },
+        "Email": "str_opt",
+    }),
+    ("RegimeTributacao", "num_str"),
+    ("DataPagamento", "str_opt"),
+    ("Discriminacao", "str"),
+    ("TipoNFTS", "num_str"),
+    ("Tomador", {
+        "CPFCNPJ": {
+            "CPF": "str",
+            "CNPJ": "str",
+        },
+        "RazaoSocial": "str",
+    }),
+])
+
+def _flatten_order_map(order_map: OrderedDict) -> tuple:
+    """Converte o order_map aninhado em tuplas (tag, tag_bytes, kind, sub_schema)."""
+    records = []
+    for tag_name, definition in order_map.items():
+        tag_bytes = tag_name.encode("utf-8")
+        if isinstance(definition, dict):
+            records.append((tag_name, tag_bytes, _KIND_GROUP, _flatten_order_map(definition)))
+        else:
+            records.append((tag_name, tag_bytes, _KIND_BY_NAME[definition], None))
+    return tuple(records)
+
+# Schema achatado, calculado uma única vez no import (caminho quente por NFTS)
+CANONICAL_SCHEMA = _flatten_order_map(canonical_order_map)
+
+# lxml escapa &, <, > e \r no texto — reproduzir o mesmo escaping
+_XML_TEXT_ENTITIES = {'\r': '&#13;'}
+
+# Buffer pré-alocado e reutilizado entre NFTS do mesmo lote: um canonical
+# típico tem 2–4 KB, então 8 KiB evita qualquer recrescimento no caso comum.
+# A posição de escrita é controlada manualmente (pos) — "limpar" o buffer é
+# só recomeçar de pos=0, sem realocação. Não é thread-safe, mas toda a
+# canonicalização acontece na thread principal (as threads só assinam).
+_CANONICAL_BUF = bytearray(8192)
+
+def _write(buf: bytearray, pos: int, chunk: bytes) -> int:
+    """Escreve chunk em buf[pos:], crescendo o buffer (dobrando) se preciso."""
+    end = pos + len(chunk)
+    if end > len(buf):
+        buf.extend(b'\x00' * max(len(buf), end - len(buf)))
+    buf[pos:end] = chunk
+    return end
+
+def _emit(buf: bytearray, pos: int, tag: bytes, text: str) -> int:
+    """Emite <tag>texto</tag> (texto escapado) direto no buffer."""
+    return _write(buf, pos, b'<%s>%s</%s>' % (
+        tag, escape(text, _XML_TEXT_ENTITIES).encode("utf-8"), tag))
+
+def _emit_fragment(buf: bytearray, pos: int, node: etree._Element, schema: tuple) -> int:
+    # um único passe sobre os filhos (evita um XPath por campo)
+    children_by_tag = _children_by_localname(node)
+    for tag_name, tag_bytes, kind, sub_schema in schema:
+        original_child = children_by_tag.get(tag_name)
+        if original_child is None:
+            continue
+        if kind < _KIND_GROUP:
+            final = _NORMALIZERS[kind](original_child.text or "")
+            if final == "":
+                continue
+            pos = _emit(buf, pos, tag_bytes, final)
+        else:
+            # escreve a abertura; se o grupo ficar vazio, basta não avançar pos
+            mark = pos
+            inner = _write(buf, pos, b'<%s>' % tag_bytes)
+            inner2 = _emit_fragment(buf, inner, original_child, sub_schema)
+            if inner2 == inner:
+                pos = mark
+            else:
+                pos = _write(buf, inner2, b'</%s>' % tag_bytes)
+    return pos
+
 def build_tpNFTS_bytes(nfts_node: etree._Element) -> bytes:
     """
     Constrói a representação canônica tpNFTS (bytes utf-8, sem declaração),
     usada para gerar o hash/assinatura conforme manual.
     """
-    clean_tp = copy.deepcopy(nfts_node)
-    assin = find_child(clean_tp, "Assinatura")
-    if assin is not None:
-        clean_tp.remove(assin)
-
-    canonical_order_map = OrderedDict([
-        ("TipoDocumento", "str"),
-        ("ChaveDocumento", {
-            "InscricaoMunicipal": "str",
-            "SerieNFTS": "serie",
-            "NumeroDocumento": "str",
-        }),
-        ("DataPrestacao", "str"),
-        ("StatusNFTS", "str"),
-        ("TributacaoNFTS", "str"),
-        ("ValorServicos", "float_currency"),
-        ("ValorDeducoes", "float_currency"),
-        ("CodigoServico", "num_str"),
-        ("CodigoSubItem", "num_str"),
-        ("AliquotaServicos", "float"),
-        ("ISSRetidoTomador", "bool"),
-        ("ISSRetidoIntermediario", "bool"),
-        ("Prestador", {
-            "CPFCNPJ": {
-                "CNPJ": "str",
-                "CPF": "str",
-            },
-            "InscricaoMunicipal": "str",
-            "RazaoSocialPrestador": "str",
-            "Endereco": {
-                "TipoLogradouro": "str",
-                "Logradouro": "str",
-                "NumeroEndereco": "str",
-                "ComplementoEndereco": "str_opt",
-                "Bairro": "str",
-                "Cidade": "num_str",
-                "UF": "str",
-                "CEP": "num_str",
-            },
-            "Email": "str_opt",
-        }),
-        ("RegimeTributacao", "num_str"),
-        ("DataPagamento", "str_opt"),
-        ("Discriminacao", "str"),
-        ("TipoNFTS", "num_str"),
-        ("Tomador", {
-            "CPFCNPJ": {
-                "CPF": "str",
-                "CNPJ": "str",
-            },
-            "RazaoSocial": "str",
-        }),
-    ])
-
-    def build_fragment(node: etree._Element, order_map: OrderedDict) -> list:
-        elems = []
-        for tag_name, definition in order_map.items():
-            original_child = find_child(node, tag_name)
-            if original_child is None:
-                continue
-            if isinstance(definition, str):
-                text_value = original_child.text or ""
-                if definition == "num_str":
-                    final = normalize_numeric_string(text_value)
-                    # final = text_value.replace('\xa0', ' ').strip()
-                elif definition == "float_currency":
-                    final = normalize_float_value(text_value, format_decimals=True)
-                elif definition == "float":
-                    final = normalize_float_value(text_value, format_decimals=False)
-                elif definition == "bool":
-                    final = normalize_boolean_value(text_value)
-                elif definition == "serie":
-                    final = normalize_serie_nfts(text_value)
-                else:
-                    final = text_value.replace('\xa0', ' ').strip()
-                if final == "":
-                    continue
-                el = etree.Element(tag_name)
-                el.text = final
-                elems.append(el)
-            elif isinstance(definition, dict):
-                nested = build_fragment(original_child, definition)
-                if nested:
-                    parent = etree.Element(tag_name)
-                    parent.extend(nested)
-                    elems.append(parent)
-        return elems
-
-    canonical_root = etree.Element("tpNFTS")
-    canonical_root.extend(build_fragment(clean_tp, canonical_order_map))
-
-    # serialize to bytes (utf-8), no xml declaration, no pretty print
-    b = etree.tostring(canonical_root, encoding="utf-8", xml_declaration=False, pretty_print=False)
-    # remove BOM if exists
-    if b.startswith(b'\xef\xbb\xbf'):
-        b = b[len(b'\xef\xbb\xbf'):]
-    return b
+    # não é preciso copiar/remover <Assinatura>: o schema canônico não a
+    # contém, então ela é ignorada naturalmente na travessia
+    if _build_canonical_c is not None:
+        return _build_canonical_c(nfts_node, CANONICAL_SCHEMA, _NORMALIZERS)
+
+    buf = _CANONICAL_BUF
+    pos = _write(buf, 0, b'<tpNFTS>')
+    end = _emit_fragment(buf, pos, nfts_node, CANONICAL_SCHEMA)
+    if end == pos:
+        # mesmo formato que o serializador usava para elemento vazio
+        return b'<tpNFTS/>'
+    end = _write(buf, end, b'</tpNFTS>')
+    return bytes(buf[:end])
 
 # ---------------- assinatura SHA1 PKCS#1 v1.5 ----------------
 
+# Padding/hash são imutáveis — instâncias únicas reutilizadas em todos os sign()
+_PKCS1V15 = padding.PKCS1v15()
+_SHA1 = hashes.SHA1()
+
 def compute_sha1_hash(data_bytes: bytes) -> bytes:
     """
     Calcula o hash SHA1 dos dados.
     """
-    hasher = hashes.Hash(hashes.SHA1())
+    hasher = hashes.Hash(_SHA1)
     hasher.update(data_bytes)
     return hasher.finalize()
 
-def sign_bytes_sha1_pkcs1(private_key_obj, data_bytes: bytes, debug_dir: str = None, nfts_counter: int = 0) -> bytes:
+def sign_bytes_sha1_pkcs1(private_key_obj, data_bytes: bytes) -> bytes:
     """
     Assina os bytes usando SHA1 + PKCS1v1.5.
-    Calcula o hash explicitamente para debug.
     """
-    # Calcular hash explicitamente
-    hash_bytes = compute_sha1_hash(data_bytes)
-    
-    # Salvar hash para debug (comparação com C#)
-    if debug_dir:
-        try:
-            hash_file = os.path.join(debug_dir, f"hash_NFTS_{nfts_counter}.bin")
-            with open(hash_file, "wb") as hf:
-                hf.write(hash_bytes)
-            logger.critical(" hash salvo em: %s (len=%d, hex=%s)", hash_file, len(hash_bytes), hash_bytes.hex())
-        except Exception as ex:
-            logger.critical(" Aviso: Não foi possível salvar arquivo de hash: %s", ex)
-    
-    # Método 1: Assinar os dados diretamente (método atual - cryptography calcula hash internamente)
-    signature_method1 = private_key_obj.sign(
-        data_bytes,
-        padding.PKCS1v15(),
-        hashes.SHA1()
-    )
-    
-    # Método 2: Assinar o hash diretamente (como C# faz com SignHash)
-    # Nota: RSA PKCS#1 v1.5 com SHA1 requer DigestInfo prefix antes do hash
-    # O método sign() já adiciona isso automaticamente, mas ao assinar hash diretamente precisamos fazer manualmente
-    # Para testar, vamos usar a biblioteca de baixo nível
-    try:
-        from cryptography.hazmat.primitives.asymmetric import rsa
-        from cryptography.hazmat.backends import default_backend
-        
-        # Construir DigestInfo para SHA1 (conforme PKCS#1 v1.5)
-        # SHA1 DigestInfo: 30 21 30 09 06 05 2b 0e 03 02 1a 05 00 04 14 [20 bytes hash]
-        digest_info = bytes.fromhex('3021300906052b0e03021a05000414') + hash_bytes
-        
-        # Assinar usando operação de baixo nível
-        from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
-        if isinstance(private_key_obj, RSAPrivateKey):
-            # Método de baixo nível: encrypt com private key = sign
-            # Mas cryptography não expõe isso diretamente, vamos usar apenas o método 1
-            signature_method2 = signature_method1  # fallback para método 1
-        else:
-            signature_method2 = signature_method1
-    except Exception:
-        signature_method2 = signature_method1
-    
-    # Salvar ambas as assinaturas para comparação
-    if debug_dir:
-        try:
-            sig_method1_file = os.path.join(debug_dir, f"signature_NFTS_{nfts_counter}_method1.bin")
-            with open(sig_method1_file, "wb") as sf:
-                sf.write(signature_method1)
-            logger.critical(" assinatura método 1 (sign data) salva em: %s (len=%d)", sig_method1_file, len(signature_method1))
-            
-            if signature_method1 != signature_method2:
-                sig_method2_file = os.path.join(debug_dir, f"signature_NFTS_{nfts_counter}_method2.bin")
-                with open(sig_method2_file, "wb") as sf:
-                    sf.write(signature_method2)
-                logger.critical(" assinatura método 2 (sign hash) salva em: %s (len=%d)", sig_method2_file, len(signature_method2))
-        except Exception as ex:
-            logger.critical(" Aviso: Não foi possível salvar arquivos de assinatura de comparação: %s", ex)
-    
-    return signature_method1
+    return private_key_obj.sign(data_bytes, _PKCS1V15, _SHA1)
+
+def sign_batch_sha1_pkcs1(private_key_obj, canonicals: list) -> list:
+    """
+    Assina um lote de representações canônicas. Cada assinatura é
+    independente e o OpenSSL libera o GIL durante o RSA, então lotes com
+    mais de um NFTS são assinados em paralelo via thread pool.
+    """
+    if len(canonicals) <= 1:
+        return [sign_bytes_sha1_pkcs1(private_key_obj, cb) for cb in canonicals]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        return list(ex.map(
+            lambda cb: private_key_obj.sign(cb, _PKCS1V15, _SHA1),
+            canonicals,
+        ))
 
 # ---------------- assinatura do documento (xmlsec) - opcional ----------------
 
@@ -347,14 +429,31 @@ def sign_document_xmlsec(root: etree._Element, key_pem_path: str, cert_pem_path:
 
 # ---------------- SOAP envelope builder ----------------
 
-def build_soap_envelope(xml_string: str) -> bytes:
-    envelope = etree.Element("{%s}Envelope" % NS_SOAP, nsmap={'soap': NS_SOAP})
-    body = etree.SubElement(envelope, "{%s}Body" % NS_SOAP)
-    request = etree.SubElement(body, "{%s}TesteEnvioLoteNFTSRequest" % NS_SP)
-    etree.SubElement(request, "{%s}VersaoSchema" % NS_SP).text = "2"
-    mensagem = etree.SubElement(request, "{%s}MensagemXML" % NS_SP)
-    mensagem.text = etree.CDATA(xml_string)
-    return etree.tostring(envelope, encoding="utf-8", xml_declaration=True, pretty_print=True)
+# O envelope é fixo fora do CDATA — montado uma vez como literais de bytes
+_SOAP_PREFIX = (
+    b'<?xml version="1.0" encoding="utf-8"?>\n'
+    b'<soap:Envelope xmlns:soap="' + NS_SOAP.encode("ascii") + b'">'
+    b'<soap:Body>'
+    b'<TesteEnvioLoteNFTSRequest xmlns="' + NS_SP.encode("ascii") + b'">'
+    b'<VersaoSchema>2</VersaoSchema>'
+    b'<MensagemXML><![CDATA['
+)
+_SOAP_SUFFIX = (
+    b']]></MensagemXML>'
+    b'</TesteEnvioLoteNFTSRequest>'
+    b'</soap:Body>'
+    b'</soap:Envelope>'
+)
+
+def write_soap_envelope(output_path: str, signed_xml_bytes: bytes) -> None:
+    """Escreve o envelope SOAP com o XML assinado em CDATA, tudo em bytes."""
+    if b']]>' in signed_xml_bytes:
+        # CDATA não pode conter ']]>' — divide em duas seções no ponto
+        signed_xml_bytes = signed_xml_bytes.replace(b']]>', b']]]]><![CDATA[>')
+    with open(output_path, "wb") as out_f:
+        out_f.write(_SOAP_PREFIX)
+        out_f.write(signed_xml_bytes)
+        out_f.write(_SOAP_SUFFIX)
 
 # ---------------- verify utility ----------------
 
@@ -369,8 +468,7 @@ def verify_signed_nfts(xml_path: str, pfx_path: str, pfx_pass: str):
     _, cert, _ = pkcs12.load_key_and_certificates(pfx_data, pwd)
     pubkey = cert.public_key()
 
-    parser = etree.XMLParser(remove_blank_text=True)
-    tree = etree.parse(xml_path, parser)
+    tree = etree.parse(xml_path, _PARSER)
     root = tree.getroot()
 
     nfts_nodes = root.xpath('//*[local-name()="NFTS"]')
@@ -424,112 +522,118 @@ def verify_signed_nfts(xml_path: str, pfx_path: str, pfx_pass: str):
 
 def sign_file(input_xml_path: str, pfx_path: str, pfx_pass: str, output_soap_path: str, debug: bool=False):
     logger.critical("Lendo XML de entrada: %s", input_xml_path)
-    parser = etree.XMLParser(remove_blank_text=True)
-    with open(input_xml_path, "rb") as f:
-        xml_bytes = f.read()
-    # parse as element tree
-    tree = etree.fromstring(xml_bytes, parser=parser)
-    root = tree if isinstance(tree, etree._Element) else tree.getroot()
-
-    debug_dir = ensure_path_for_debug() # LINHA COMENTADA
-    logger.critical("Debug dir: %s", debug_dir) # LINHA COMENTADA
+    # iterparse entrega cada <NFTS> assim que sua tag fecha, então a
+    # canonicalização acontece durante o próprio parse (streaming), sem
+    # carregar o arquivo em bytes nem varrer a árvore com '//' depois.
+    # A árvore completa continua disponível ao final para o envelope SOAP.
+    context = etree.iterparse(input_xml_path, events=('end',), tag='{*}NFTS',
+                              remove_blank_text=True)
+    nfts_nodes = []
+    canonicals = []
+    for _, nfts in context:
+        nfts_nodes.append(nfts)
+        canonicals.append(build_tpNFTS_bytes(nfts))
+    root = context.root
+
+    # arquivos de debug só são gerados quando --debug foi pedido
+    debug_dir = None
+    if debug:
+        debug_dir = ensure_path_for_debug()
+        logger.critical("Debug dir: %s", debug_dir)
 
     logger.critical("Extraindo chave privada e certificado do PFX...")
     private_key, cert = read_pkcs12(pfx_path, pfx_pass)
 
-    # save PEMs for xmlsec (if necessary)
-    #tmpdir = tempfile.gettempdir()
-    tmpdir = debug_dir
-    cert_pem_path = os.path.join(tmpdir, "tmp_cert_nfts.pem")
-    key_pem_path = os.path.join(tmpdir, "tmp_key_nfts.pem")
-    try:
-        with open(cert_pem_path, "wb") as f:
-            f.write(cert.public_bytes(Encoding.PEM))
-        with open(key_pem_path, "wb") as f:
-            f.write(private_key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
-    except Exception:
-        logger.critical("Não foi possível gravar PEMs temporários (continua sem xmlsec).")
-
-    # find NFTS nodes (ignore namespace)
-    nfts_nodes = root.xpath('//*[local-name()="NFTS"]')
     if not nfts_nodes:
         logger.critical("Nenhum elemento <NFTS> encontrado no XML.")
         raise SystemExit(1)
     else:
         logger.critical("Encontrados %d NFTS nodes", len(nfts_nodes))
 
-    for i, nfts in enumerate(nfts_nodes, start=1):
-        logger.critical("Processando NFTS #%d ...", i)
-
-        canonical_bytes = build_tpNFTS_bytes(nfts)  # bytes for signing
+    # canonicais já montados durante o parse; assina o lote em paralelo
+    signatures = sign_batch_sha1_pkcs1(private_key, canonicals)
 
-        canonical_file = os.path.join(debug_dir, f"canonical_NFTS_{i}.bin") # LINHA COMENTADA
-        canonical_txt_file = os.path.join(debug_dir, f"canonical_NFTS_{i}.txt")
-        with open(canonical_file, "wb") as cf: # LINHA COMENTADA
-            cf.write(canonical_bytes) # LINHA COMENTADA
-        with open(canonical_txt_file, "w", encoding="utf-8") as ctf:
-            ctf.write(canonical_bytes.decode("utf-8"))
-        logger.critical(" canonical salvo em: %s (len=%d)", canonical_file, len(canonical_bytes)) # LINHA COMENTADA
-        logger.critical(" canonical (texto) salvo em: %s", canonical_txt_file)
+    for i, (nfts, canonical_bytes, sig_bytes) in enumerate(
+            zip(nfts_nodes, canonicals, signatures), start=1):
+        logger.critical("Processando NFTS #%d ...", i)
 
-        # sign with SHA1 PKCS#1 v1.5
-        sig_bytes = sign_bytes_sha1_pkcs1(private_key, canonical_bytes, debug_dir, i)
         sig_b64 = base64.b64encode(sig_bytes).decode("ascii")
 
-        # write signature debug files
-        sig_bin_file = os.path.join(debug_dir, f"signature_NFTS_{i}.bin") # LINHA COMENTADA
-        sig_b64_file = os.path.join(debug_dir, f"signature_NFTS_{i}.b64") # LINHA COMENTADA
-        with open(sig_bin_file, "wb") as sf: # LINHA COMENTADA
-            sf.write(sig_bytes) # LINHA COMENTADA
-        with open(sig_b64_file, "w", encoding="utf-8") as sf64: # LINHA COMENTADA
-            sf64.write(sig_b64) # LINHA COMENTADA
-        logger.critical(" assinatura salva em: %s / %s", sig_bin_file, sig_b64_file) # LINHA COMENTADA
+        if debug:
+            canonical_file = os.path.join(debug_dir, f"canonical_NFTS_{i}.bin")
+            canonical_txt_file = os.path.join(debug_dir, f"canonical_NFTS_{i}.txt")
+            _write_debug_bin(canonical_file, canonical_bytes)
+            with open(canonical_txt_file, "w", encoding="utf-8") as ctf:
+                ctf.write(canonical_bytes.decode("utf-8"))
+            logger.critical(" canonical salvo em: %s (len=%d)", canonical_file, len(canonical_bytes))
+            logger.critical(" canonical (texto) salvo em: %s", canonical_txt_file)
+
+            # salvar hash para debug (comparação com C#)
+            hash_bytes = compute_sha1_hash(canonical_bytes)
+            hash_file = os.path.join(debug_dir, f"hash_NFTS_{i}.bin")
+            _write_debug_bin(hash_file, hash_bytes)
+            logger.critical(" hash salvo em: %s (len=%d, hex=%s)", hash_file, len(hash_bytes), hash_bytes.hex())
+
+            # write signature debug files
+            sig_bin_file = os.path.join(debug_dir, f"signature_NFTS_{i}.bin")
+            sig_b64_file = os.path.join(debug_dir, f"signature_NFTS_{i}.b64")
+            _write_debug_bin(sig_bin_file, sig_bytes)
+            with open(sig_b64_file, "w", encoding="utf-8") as sf64:
+                sf64.write(sig_b64)
+            logger.critical(" assinatura salva em: %s / %s", sig_bin_file, sig_b64_file)
 
-        # insert Assinatura element (clean - remove whitespace/newlines)
+        # insert Assinatura element
         assin = find_child(nfts, "Assinatura")
         if assin is None:
             assin = etree.Element("Assinatura")
             nfts.append(assin)
-        # strip whitespace and set base64 (single line)
-        assin_text = "".join(sig_b64.split())
-        assin.text = assin_text
+        # b64encode nunca produz whitespace — atribuição direta
+        assin.text = sig_b64
 
         # Optionally, ensure there are no extraneous namespace declarations on the NFTS subtree
         # (we preserve the rest of the document as-is, since schema expects xmlns="" on children)
 
-    # sign entire document (opcional)
+    # sign entire document (opcional) — os PEMs temporários só existem aqui:
+    # quando o xmlsec não está disponível (o caso comum), nada é serializado
+    # nem gravado em disco, e a chave privada nunca sai da memória
     try:
         if XMLSEC_AVAILABLE:
             logger.critical("Assinando documento inteiro com xmlsec (opcional)...")
-            sign_document_xmlsec(root, key_pem_path, cert_pem_path)
+            cert_pem = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
+            key_pem = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
+            try:
+                with cert_pem:
+                    cert_pem.write(cert.public_bytes(Encoding.PEM))
+                with key_pem:
+                    # restringe a chave ao dono antes de escrever o PKCS8
+                    os.chmod(key_pem.name, 0o600)
+                    key_pem.write(private_key.private_bytes(
+                        Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
+                sign_document_xmlsec(root, key_pem.name, cert_pem.name)
+            finally:
+                for tmp_path in (cert_pem.name, key_pem.name):
+                    try:
+                        os.unlink(tmp_path)
+                    except OSError:
+                        pass
             logger.critical("Assinatura do documento adicionada via xmlsec.")
         else:
             logger.critical("xmlsec não disponível — pulando assinatura do documento inteiro.")
     except Exception as e:
         logger.critical("xmlsec falhou (opcional): %s", e)
 
-    # serialize signed XML (force UTF-8 without BOM)
-    signed_xml_bytes = etree.tostring(root, encoding="utf-8", xml_declaration=True, pretty_print=False)
-    if signed_xml_bytes.startswith(b'\xef\xbb\xbf'):
-        signed_xml_bytes = signed_xml_bytes[len(b'\xef\xbb\xbf'):]
-    signed_xml_str = signed_xml_bytes.decode("utf-8")
-
-    # build SOAP with CDATA
-    soap_bytes = build_soap_envelope(signed_xml_str)
-    with open(output_soap_path, "wb") as out_f:
-        out_f.write(soap_bytes)
+    # o XML assinado permanece em bytes do serializador até o arquivo de
+    # saída — nenhum decode/re-encode do payload inteiro. A declaração é um
+    # literal (mesmos bytes que o lxml emitiria com xml_declaration=True,
+    # que nunca inclui BOM), evitando os caminhos condicionais do serializador
+    signed_xml_bytes = (b"<?xml version='1.0' encoding='utf-8'?>\n"
+                        + etree.tostring(root, encoding="utf-8",
+                                         xml_declaration=False, pretty_print=False))
+    write_soap_envelope(output_soap_path, signed_xml_bytes)
 
     logger.critical("SOAP TesteEnvioLoteNFTS salvo em: %s", output_soap_path)
-    logger.critical("Arquivos debug em: %s", debug_dir) # LINHA COMENTADA
-
-    # cleanup temporary PEMs
-    try:
-        if os.path.exists(cert_pem_path):
-            os.remove(cert_pem_path)
-        if os.path.exists(key_pem_path):
-            os.remove(key_pem_path)
-    except Exception:
-        pass
+    if debug:
+        logger.critical("Arquivos debug em: %s", debug_dir)
 
 # ---------------- CLI ----------------
 
@@ -23,14 +23,16 @@ import os
 import tempfile
 import logging
 import base64
-import copy
+import hashlib
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Optional
+from xml.sax.saxutils import escape
 
 from lxml import etree
 from cryptography.hazmat.primitives.serialization import pkcs12, Encoding, PrivateFormat, NoEncryption
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import padding, utils
 
 # xmlsec é opcional (assinatura do documento inteiro)
 try:
@@ -72,11 +74,23 @@ NFTS_ELEMENT_ORDER = [
     "PagamentoParceladoAntecipado"
 ]
 
+# tags que precedem a Assinatura no XSD — usado para achar o índice de
+# inserção com um único passe pelos filhos existentes
+_TAGS_BEFORE_ASSINATURA = frozenset(NFTS_ELEMENT_ORDER[:NFTS_ELEMENT_ORDER.index("Assinatura")])
+
 # ---------------- util ----------------
 
+def _local(tag: str) -> str:
+    # nome local por fatiamento da própria string do tag — etree.QName aloca
+    # um objeto por filho visitado só para ler .localname
+    return tag[tag.rindex('}') + 1:] if tag[0] == '{' else tag
+
 def find_child(parent: etree._Element, tagname: str) -> Optional[etree._Element]:
-    nodes = parent.xpath('./*[local-name() = $name]', name=tagname)
-    return nodes[0] if nodes else None
+    # iterchildren é a primitiva mais rápida do lxml e para no primeiro match,
+    # ao contrário do XPath com local-name() que sempre materializa a lista
+    # inteira. Os filhos de <NFTS> vivem no namespace vazio (xmlns=""), então
+    # o curinga {*} cobre tanto esse caso quanto um eventual tree qualificado.
+    return next(parent.iterchildren('{*}' + tagname), None)
 
 def read_pkcs12(pfx_path: str, password: Optional[str]) -> Tuple[object, object]:
     with open(pfx_path, "rb") as f:
@@ -89,103 +103,160 @@ def read_pkcs12(pfx_path: str, password: Optional[str]) -> Tuple[object, object]
 
 # ---------------- Normalizações (Para o Hash) ----------------
 
+# Tabelas/constantes pré-computadas no import: translate faz um único passe em
+# C onde a cadeia de .replace() alocava uma string intermediária por chamada
+_STRIP_TABLE = str.maketrans({'\xa0': ' '})
+_FLOAT_TABLE = str.maketrans({'\xa0': ' ', ',': '.'})
+_BOOL_TRUE = frozenset(("true", "1", "s", "sim", "t", "y", "yes"))
+_fmt = "{:.2f}".format
+
 def normalize_numeric_string(text: Optional[str]) -> str:
     if text is None: return ""
-    clean_text = text.replace('\xa0', ' ').strip()
+    clean_text = text.translate(_STRIP_TABLE).strip()
     if clean_text.isdigit():
+        # caso comum (dígitos ASCII): lstrip dispensa o round-trip int()/str()
+        if clean_text.isascii(): return clean_text.lstrip('0') or '0'
         try: return str(int(clean_text))
         except: pass
     return clean_text
 
 def normalize_serie_nfts(text: Optional[str]) -> str:
     if text is None: return "     "
-    return text.replace('\xa0', ' ').strip()
+    return text.translate(_STRIP_TABLE).strip()
 
 def normalize_float_value(text: Optional[str], format_decimals: bool = True) -> str:
     if text is None: return ""
-    clean_text = text.replace('\xa0', ' ').replace(',', '.').strip()
+    clean_text = text.translate(_FLOAT_TABLE).strip()
     try:
         float_value = float(clean_text)
-        return "{:.2f}".format(float_value) if format_decimals else str(float_value)
+        return _fmt(float_value) if format_decimals else str(float_value)
     except: return clean_text
 
 def normalize_boolean_value(text: Optional[str]) -> str:
     if text is None: return "false"
-    clean_text = text.replace('\xa0', ' ').strip().lower()
-    return "true" if clean_text in ("true", "1", "s", "sim", "t", "y", "yes") else "false"
+    clean_text = text.translate(_STRIP_TABLE).strip().lower()
+    return "true" if clean_text in _BOOL_TRUE else "false"
+
+# Acelerador opcional compilado (normalize.pyx — build via setup.py): quando o
+# módulo existe, substitui as quatro funções acima por versões Cython com
+# resultado byte a byte idêntico; sem ele, valem as versões Python puras
+try:
+    from normalize import (  # type: ignore  # noqa: F811
+        normalize_numeric_string, normalize_serie_nfts,
+        normalize_float_value, normalize_boolean_value)
+except ImportError:
+    pass
 
 # ---------------- Construir string canônica (tpNFTS) COMPLETA ----------------
 
+def _norm_plain(text: str) -> str:
+    return text.translate(_STRIP_TABLE).strip()
+
+def _norm_float_free(text: str) -> str:
+    return normalize_float_value(text, False)
+
+# Montado uma única vez no import — reconstruir este dict aninhado a cada
+# NFTS custa milhares de alocações idênticas em um lote grande. Os valores
+# são referências de função: uma chamada direta por campo no lugar da escada
+# de comparações de string que build_fragment fazia a cada folha
+_CANONICAL_ORDER_MAP = OrderedDict([
+    ("TipoDocumento", _norm_plain),
+    ("ChaveDocumento", {"InscricaoMunicipal": _norm_plain, "SerieNFTS": normalize_serie_nfts, "NumeroDocumento": _norm_plain}),
+    ("DataPrestacao", _norm_plain), ("StatusNFTS", _norm_plain), ("TributacaoNFTS", _norm_plain),
+    ("ValorServicos", normalize_float_value), ("ValorDeducoes", normalize_float_value),
+    ("CodigoServico", normalize_numeric_string), ("CodigoSubItem", normalize_numeric_string), ("AliquotaServicos", _norm_float_free),
+    ("ISSRetidoTomador", normalize_boolean_value), ("ISSRetidoIntermediario", normalize_boolean_value),
+    ("Prestador", {
+        "CPFCNPJ": {"CNPJ": _norm_plain, "CPF": _norm_plain},
+        "InscricaoMunicipal": _norm_plain, "RazaoSocialPrestador": _norm_plain,
+        "Endereco": {
+            "TipoLogradouro": _norm_plain, "Logradouro": _norm_plain, "NumeroEndereco": _norm_plain,
+            "ComplementoEndereco": _norm_plain, "Bairro": _norm_plain, "Cidade": normalize_numeric_string, "UF": _norm_plain, "CEP": normalize_numeric_string
+        },
+        "Email": _norm_plain,
+    }),
+    ("RegimeTributacao", normalize_numeric_string), ("DataPagamento", _norm_plain), ("Discriminacao", _norm_plain),
+    ("TipoNFTS", normalize_numeric_string),
+    ("Tomador", {"CPFCNPJ": {"CPF": _norm_plain, "CNPJ": _norm_plain}, "RazaoSocial": _norm_plain}),
+    #("CodigoCEI", _norm_plain),
+    #("MatriculaObra", _norm_plain),
+    #("clocalPrestServ", normalize_numeric_string),
+    #("cPaisPrestServ", normalize_numeric_string),
+    #("ValorPIS", normalize_float_value),
+    #("ValorCOFINS", normalize_float_value), 
+    #("ValorINSS", normalize_float_value), 
+    #("ValorIR", normalize_float_value),
+    #("ValorCSLL", normalize_float_value), 
+    #("ValorIPI", normalize_float_value),
+    #("RetornoComplementarIBSCBS", _norm_plain),
+    #("ValorInicialCobrado", normalize_float_value), 
+    #("ValorFinalCobrado", normalize_float_value), 
+    #("ValorMulta", normalize_float_value),
+    #("ValorJuros", normalize_float_value), 
+    #("ExigibilidadeSuspensa", _norm_plain),
+    #("PagamentoParceladoAntecipado", _norm_plain),
+])
+
+# lxml escapa &, < e > (e \r como &#13;) no texto — a montagem direta em
+# bytes reproduz exatamente o mesmo escaping
+_XML_TEXT_ENTITIES = {'\r': '&#13;'}
+
 def build_tpNFTS_bytes(nfts_node: etree._Element) -> bytes:
-    clean_tp = copy.deepcopy(nfts_node)
-    assin = find_child(clean_tp, "Assinatura")
-    if assin is not None:
-        clean_tp.remove(assin)
-
-    canonical_order_map = OrderedDict([
-        ("TipoDocumento", "str"),
-        ("ChaveDocumento", {"InscricaoMunicipal": "str", "SerieNFTS": "serie", "NumeroDocumento": "str"}),
-        ("DataPrestacao", "str"), ("StatusNFTS", "str"), ("TributacaoNFTS", "str"),
-        ("ValorServicos", "float_currency"), ("ValorDeducoes", "float_currency"),
-        ("CodigoServico", "num_str"), ("CodigoSubItem", "num_str"), ("AliquotaServicos", "float"),
-        ("ISSRetidoTomador", "bool"), ("ISSRetidoIntermediario", "bool"),
-        ("Prestador", {
-            "CPFCNPJ": {"CNPJ": "str", "CPF": "str"},
-            "InscricaoMunicipal": "str", "RazaoSocialPrestador": "str",
-            "Endereco": {
-                "TipoLogradouro": "str", "Logradouro": "str", "NumeroEndereco": "str",
-                "ComplementoEndereco": "str", "Bairro": "str", "Cidade": "num_str", "UF": "str", "CEP": "num_str"
-            },
-            "Email": "str",
-        }),
-        ("RegimeTributacao", "num_str"), ("DataPagamento", "str"), ("Discriminacao", "str"),
-        ("TipoNFTS", "num_str"),
-        ("Tomador", {"CPFCNPJ": {"CPF": "str", "CNPJ": "str"}, "RazaoSocial": "str"}),
-        #("CodigoCEI", "str"),
-        #("MatriculaObra", "str"),
-        #("clocalPrestServ", "num_str"),
-        #("cPaisPrestServ", "num_str"),
-        #("ValorPIS", "float_currency"),
-        #("ValorCOFINS", "float_currency"), 
-        #("ValorINSS", "float_currency"), 
-        #("ValorIR", "float_currency"),
-        #("ValorCSLL", "float_currency"), 
-        #("ValorIPI", "float_currency"),
-        #("RetornoComplementarIBSCBS", "str"),
-        #("ValorInicialCobrado", "float_currency"), 
-        #("ValorFinalCobrado", "float_currency"), 
-        #("ValorMulta", "float_currency"),
-        #("ValorJuros", "float_currency"), 
-        #("ExigibilidadeSuspensa", "str"),
-        #("PagamentoParceladoAntecipado", "str"),
-    ])
+    # sem deepcopy: a canônica é montada do zero seguindo o order_map, e como
+    # "Assinatura" não consta no mapa o elemento é ignorado naturalmente —
+    # copiar a árvore inteira só para removê-lo era puro desperdício.
+    # Os fragmentos são bytes concatenados com join: montar uma etree
+    # descartável e reserializar com tostring era usar a árvore como
+    # string-builder, com uma alocação de Element por campo.
 
     def build_fragment(node: etree._Element, order_map: OrderedDict) -> list:
-        elems = []
+        # um passe único indexando os filhos por nome local — N buscas
+        # find_child por parent refariam a varredura da lista de filhos
+        # para cada entrada do order_map (O(N²))
+        children = {_local(c.tag): c for c in node if isinstance(c.tag, str)}
+        frags = []
         for tag_name, definition in order_map.items():
-            original_child = find_child(node, tag_name)
+            original_child = children.get(tag_name)
             if original_child is None: continue
-            if isinstance(definition, str):
-                text_value = original_child.text or ""
-                if definition == "num_str": final = normalize_numeric_string(text_value)
-                elif definition == "float_currency": final = normalize_float_value(text_value, True)
-                elif definition == "float": final = normalize_float_value(text_value, False)
-                elif definition == "bool": final = normalize_boolean_value(text_value)
-                elif definition == "serie": final = normalize_serie_nfts(text_value)
-                else: final = text_value.replace('\xa0', ' ').strip()
+            if not isinstance(definition, dict):
+                text_value = original_child.text
+                # campo opcional vazio: pula o normalizador — só o booleano
+                # produz saída ("false") a partir de texto vazio, então ele
+                # é a única exceção
+                if not text_value and definition is not normalize_boolean_value:
+                    continue
+                final = definition(text_value or "")
                 if final == "": continue
-                el = etree.Element(tag_name); el.text = final; elems.append(el)
-            elif isinstance(definition, dict):
+                tag = tag_name.encode("ascii")
+                frags.append(b'<' + tag + b'>'
+                             + escape(final, _XML_TEXT_ENTITIES).encode("utf-8")
+                             + b'</' + tag + b'>')
+            else:
                 nested = build_fragment(original_child, definition)
                 if nested:
-                    parent = etree.Element(tag_name); parent.extend(nested); elems.append(parent)
-        return elems
-
-    canonical_root = etree.Element("tpNFTS")
-    canonical_root.extend(build_fragment(clean_tp, canonical_order_map))
-    b = etree.tostring(canonical_root, encoding="utf-8", xml_declaration=False, pretty_print=False)
-    if b.startswith(b'\xef\xbb\xbf'): b = b[len(b'\xef\xbb\xbf'):]
-    return b
+                    tag = tag_name.encode("ascii")
+                    frags.append(b'<' + tag + b'>' + b''.join(nested) + b'</' + tag + b'>')
+        return frags
+
+    frags = build_fragment(nfts_node, _CANONICAL_ORDER_MAP)
+    if not frags:
+        # mesmo formato que o tostring emitia para o elemento vazio
+        return b'<tpNFTS/>'
+    return b''.join([b'<tpNFTS>', *frags, b'</tpNFTS>'])
+
+# ---------------- Assinatura (RSA SHA1 PKCS#1 v1.5) ----------------
+
+# padding e hash são imutáveis — instâncias únicas reutilizadas em todos os
+# sign() em vez de construir PKCS1v15()/SHA1() novos a cada NFTS
+_PAD = padding.PKCS1v15()
+_HASH = hashes.SHA1()
+# o digest é calculado via hashlib (caminho direto ao SHA-1 do OpenSSL, com
+# SHA-NI onde houver, e menos camadas Python que o wrapper da cryptography);
+# Prehashed faz o sign() receber o digest pronto em vez dos bytes crus
+_PREHASHED_SHA1 = utils.Prehashed(_HASH)
+
+def _sign_canonical(private_key, canonical_bytes: bytes) -> bytes:
+    return private_key.sign(hashlib.sha1(canonical_bytes).digest(), _PAD, _PREHASHED_SHA1)
 
 # ---------------- Assinatura do documento inteiro (xmlsec) ----------------
 
@@ -210,29 +281,43 @@ def sign_document_xmlsec(root: etree._Element, key_pem_path: str, cert_pem_path:
 
 def sign_file(input_xml_path: str, pfx_path: str, pfx_pass: str, output_soap_path: str):
     logger.debug("Lendo XML de entrada: %s", input_xml_path)
-    parser = etree.XMLParser(remove_blank_text=True)
-    tree = etree.parse(input_xml_path, parser)
-    root = tree.getroot()
+    # iterparse entrega cada <NFTS> assim que sua tag fecha — a canônica é
+    # montada durante o próprio parse, sem esperar o documento inteiro. A
+    # árvore completa continua acessível via context.root (necessária para o
+    # envelope SOAP no final), então nada é descartado, só antecipado.
+    nfts_nodes = []
+    canonicals = []
+    # huge_tree libera os limites do libxml2 para lotes grandes e
+    # collect_ids=False poupa o hash de IDs que nunca consultamos
+    context = etree.iterparse(input_xml_path, events=('end',), tag='{*}NFTS',
+                              remove_blank_text=True, huge_tree=True,
+                              collect_ids=False)
+    for _, nfts in context:
+        nfts_nodes.append(nfts)
+        canonicals.append(build_tpNFTS_bytes(nfts))
+    root = context.root
 
     logger.debug("Extraindo chave privada e certificado do PFX...")
     private_key, cert = read_pkcs12(pfx_path, pfx_pass)
 
-    tmpdir = tempfile.gettempdir()
-    cert_pem = os.path.join(tmpdir, "tmp_cert_nfts.pem")
-    key_pem = os.path.join(tmpdir, "tmp_key_nfts.pem")
-    with open(cert_pem, "wb") as f: f.write(cert.public_bytes(Encoding.PEM))
-    with open(key_pem, "wb") as f: f.write(private_key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
-
-    nfts_nodes = root.xpath('//*[local-name()="NFTS"]')
     if not nfts_nodes:
         logger.critical("Nenhum elemento <NFTS> encontrado no XML.")
         return
     logger.debug("Encontrados %d NFTS nodes", len(nfts_nodes))
 
-    for i, nfts in enumerate(nfts_nodes, start=1):
+    # canônicas já montadas durante o parse, na thread principal (criar
+    # proxies lxml sobre o mesmo documento em várias threads não é seguro);
+    # as assinaturas RSA liberam o GIL no OpenSSL e rodam em paralelo
+    if len(canonicals) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(canonicals), os.cpu_count() or 1)) as pool:
+            signatures = list(pool.map(lambda cb: _sign_canonical(private_key, cb), canonicals))
+    else:
+        signatures = [_sign_canonical(private_key, cb) for cb in canonicals]
+
+    # mutação da árvore de volta na thread principal (lxml não é thread-safe)
+    for i, (nfts, sig_bytes) in enumerate(zip(nfts_nodes, signatures), start=1):
         logger.debug("Processando NFTS #%d ...", i)
-        canonical_bytes = build_tpNFTS_bytes(nfts)
-        
+
         #DEBUG LINHA COMENTADA
         # --- EXPORTAÇÃO DA STRING CANÔNICA ---
         # export_folder = r"C:\temp\nfts"
@@ -246,41 +331,68 @@ def sign_file(input_xml_path: str, pfx_path: str, pfx_pass: str, output_soap_pat
         # except Exception as e:
         #     logger.critical("ERRO ao exportar string canônica: %s", str(e))
 
-        sig_bytes = private_key.sign(canonical_bytes, padding.PKCS1v15(), hashes.SHA1())
         sig_b64 = base64.b64encode(sig_bytes).decode("ascii")
 
-        elements_dict = {el.tag: el for el in nfts}
         assin_el = etree.Element("Assinatura")
-        assin_el.text = "".join(sig_b64.split())
-        elements_dict["Assinatura"] = assin_el
-
-        for el in list(nfts): nfts.remove(el)
-        for tag in NFTS_ELEMENT_ORDER:
-            if tag in elements_dict: nfts.append(elements_dict[tag])
-
+        # b64encode nunca produz whitespace — atribuição direta
+        assin_el.text = sig_b64
+
+        # só a Assinatura é nova: uma inserção no índice certo substitui o
+        # esvaziar-e-reapendar (2N mutações na lista encadeada do libxml2)
+        old = find_child(nfts, "Assinatura")
+        if old is not None: nfts.remove(old)
+        idx = next((j for j, c in enumerate(nfts)
+                    if isinstance(c.tag, str)  # pula comentários/PIs
+                    and _local(c.tag) not in _TAGS_BEFORE_ASSINATURA), len(nfts))
+        nfts.insert(idx, assin_el)
+
+    # PEMs temporários só existem quando o xmlsec vai usá-los; no caminho
+    # comum (sem xmlsec) nada é serializado nem gravado em disco
     if XMLSEC_AVAILABLE:
         logger.debug("Assinando documento inteiro com xmlsec (opcional)...")
-        sign_document_xmlsec(root, key_pem, cert_pem)
+        cert_pem = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
+        key_pem = tempfile.NamedTemporaryFile(delete=False, suffix=".pem")
+        try:
+            with cert_pem: cert_pem.write(cert.public_bytes(Encoding.PEM))
+            with key_pem: key_pem.write(private_key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
+            sign_document_xmlsec(root, key_pem.name, cert_pem.name)
+        finally:
+            for tmp_path in (cert_pem.name, key_pem.name):
+                try: os.unlink(tmp_path)
+                except OSError: pass
     else:
         logger.critical("xmlsec não disponível — pulando assinatura do documento inteiro.")
 
-    signed_xml_str = etree.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
-    envelope = etree.Element("{%s}Envelope" % NS_SOAP, nsmap={'soap': NS_SOAP})
-    body = etree.SubElement(envelope, "{%s}Body" % NS_SOAP)
-    req = etree.SubElement(body, "{%s}TesteEnvioLoteNFTSRequest" % NS_SP)
-    etree.SubElement(req, "{%s}VersaoSchema" % NS_SP).text = "2"
-    msg = etree.SubElement(req, "{%s}MensagemXML" % NS_SP)
-    msg.text = etree.CDATA(signed_xml_str)
-    
+    # serializa direto para str (encoding='unicode' evita o ciclo encode
+    # utf-8 + decode do payload inteiro); a declaração é um literal com os
+    # mesmos bytes que o tostring emitia com xml_declaration=True
+    signed_xml_str = ("<?xml version='1.0' encoding='utf-8'?>\n"
+                      + etree.tostring(root, encoding="unicode"))
+
+    # envelope escrito incrementalmente com etree.xmlfile: o tostring único
+    # materializava o envelope inteiro (CDATA incluso) numa segunda cópia em
+    # memória antes do write. Os writes de whitespace reproduzem byte a byte
+    # o layout que o pretty_print gerava.
     with open(output_soap_path, "wb") as f:
-        f.write(etree.tostring(envelope, encoding="utf-8", xml_declaration=True, pretty_print=True))
-    
-    logger.debug("SOAP TesteEnvioLoteNFTS salvo em: %s", output_soap_path)
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element("{%s}Envelope" % NS_SOAP, nsmap={'soap': NS_SOAP}):
+                xf.write('\n  ')
+                with xf.element("{%s}Body" % NS_SOAP):
+                    xf.write('\n    ')
+                    with xf.element("{%s}TesteEnvioLoteNFTSRequest" % NS_SP, nsmap={'ns0': NS_SP}):
+                        xf.write('\n      ')
+                        with xf.element("{%s}VersaoSchema" % NS_SP):
+                            xf.write('2')
+                        xf.write('\n      ')
+                        with xf.element("{%s}MensagemXML" % NS_SP):
+                            xf.write(etree.CDATA(signed_xml_str))
+                        xf.write('\n    ')
+                    xf.write('\n  ')
+                xf.write('\n')
+        f.write(b'\n')
 
-    try:
-        if os.path.exists(cert_pem): os.remove(cert_pem)
-        if os.path.exists(key_pem): os.remove(key_pem)
-    except: pass
+    logger.debug("SOAP TesteEnvioLoteNFTS salvo em: %s", output_soap_path)
 
 if __name__ == "__main__":
     if len(sys.argv) == 5: